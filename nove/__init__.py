@@ -8,20 +8,39 @@ from PyQt5 import QtCore
 from uuid import uuid4
 from subprocess import check_call
 from shutil import which
-from functools import partial
+from functools import partial, lru_cache
 from qtmodern.styles import light, dark
 from qtmodern.windows import ModernWindow
 
 # ModernWindow = lambda x: x
 import pyperclip
 import json
+import csv
+import io
 import os
+import mmap
+import codecs
+import asyncio
+import threading
+import time
+import multiprocessing
+import unicodedata
+import itertools
+import heapq
+import re
+import hashlib
+import hmac
+import signal
+import secrets
 import pydantic
 import pathlib
 import wisepy2
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 
 default_color = QColor(200, 100, 100)
 empty_seq = []
+empty_set = frozenset()
 
 
 def uuid_str():
@@ -62,21 +81,24 @@ class Document(pydantic.BaseModel):
         return self.id
 
 class QueryProxy:
-    def __init__(self, doc: Document, attrs: Attrs, attr_lookup: dict):
+    def __init__(self, doc: Document, attrs: Attrs, attr_lookup: dict, stats: typing.Optional[ContentStats] = None):
         self.doc = doc
         self.attrs = attrs
         self.attr_lookup = attr_lookup
+        self.stats = stats
     def __getattr__(self, attr):
         if attr == "名字":
             return self.doc.name
         elif attr == "文件路径":
             return self.doc.path
+        elif self.stats is not None and attr in ContentStats.names:
+            return self.stats.value(self.doc.path, attr)
         if attr_id := self.attr_lookup.get(attr, None):
-            return self.doc.attrs[attr_id]
+            return self.doc.attrs.get(attr_id)
         found = next((k for k,v in self.attrs.items() if v.name == attr), None)
         if found:
             attr_id = self.attr_lookup[attr] = self.attrs[found].id
-            return self.doc.attrs[attr_id]
+            return self.doc.attrs.get(attr_id)
         return None
 
 Value = typing.Union[int, str, float]
@@ -87,15 +109,313 @@ Docs = dict[str, Document]
 Attrs = dict[str, Attr]
 
 
+class NameIndex:
+    """
+    文档名的字符 n 元组倒排索引(单字与二元组), 用于边输入边搜索
+    名字先做 NFKC 规范化并忽略大小写, 全角半角、大小写都不影响匹配
+    另按名字长度分桶, 排序时从短到长取够 limit 个即可停止
+    """
+    # 模糊匹配最多检查这么多个候选(从短名字开始), 以免每次按键都扫描全部文档
+    fuzzy_budget = 5000
+
+    def __init__(self):
+        self.grams: dict[str, set[str]] = {}
+        self.names: dict[str, str] = {}
+        self.lengths: dict[int, set[str]] = {}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return unicodedata.normalize("NFKC", text).casefold()
+
+    @staticmethod
+    def grams_of(text: str) -> set[str]:
+        return {*text, *(text[i:i + 2] for i in range(len(text) - 1))}
+
+    def add(self, doc_id: str, name: str):
+        self.remove(doc_id)
+        name = self.names[doc_id] = self.normalize(name)
+        grams = self.grams
+        for gram in self.grams_of(name):
+            if (ids := grams.get(gram)) is None:
+                ids = grams[gram] = set()
+            ids.add(doc_id)
+        self.lengths.setdefault(len(name), set()).add(doc_id)
+
+    def remove(self, doc_id: str):
+        name = self.names.pop(doc_id, None)
+        if name is None:
+            return
+        for gram in self.grams_of(name):
+            if (ids := self.grams.get(gram)) is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del self.grams[gram]
+        bucket = self.lengths[len(name)]
+        bucket.discard(doc_id)
+        if not bucket:
+            del self.lengths[len(name)]
+
+    def _candidates(self, grams: set[str]) -> typing.AbstractSet[str]:
+        postings = sorted((self.grams.get(gram, empty_set) for gram in grams), key=len)
+        if len(postings) == 1:
+            return postings[0]
+        return postings[0].intersection(*postings[1:])
+
+    def _rank(
+        self,
+        ids: typing.AbstractSet[str],
+        match,
+        limit: int,
+        skip: typing.AbstractSet[str] = empty_set,
+        budget: typing.Optional[int] = None,
+    ) -> list[str]:
+        """
+        ids 中按 (名字长度, 名字) 排序的前 limit 个匹配, 跳过 skip 中的
+        给出 budget 时最多检查 budget 个候选, 短名字先检查
+        """
+        found = []
+        names = self.names
+        for n in sorted(self.lengths):
+            if budget is None:
+                bucket = self.lengths[n] & ids
+            elif budget <= 0:
+                break
+            else:
+                # 不求出整个交集, 取够 budget 个即止
+                small, big = sorted((self.lengths[n], ids), key=len)
+                bucket = list(itertools.islice((d for d in small if d in big), budget))
+                budget -= len(bucket)
+            hits = sorted(
+                (name, doc_id)
+                for doc_id in bucket
+                if doc_id not in skip and match(name := names[doc_id])
+            )
+            found.extend(doc_id for _, doc_id in hits)
+            if len(found) >= limit:
+                break
+        return found[:limit]
+
+    def search(self, query: str, limit: int = 200) -> list[str]:
+        """
+        空白分隔的每一段都须出现在名字中; 子串匹配排在前面,
+        其后是各字按顺序出现(中间可有间隔)的模糊匹配
+        """
+        terms = self.normalize(query).split()
+        if not terms:
+            return []
+        exact = self._candidates(
+            {gram for term in terms for gram in (self.grams_of(term) if len(term) < 3 else
+                                                 {term[i:i + 2] for i in range(len(term) - 1)})}
+        )
+        found = self._rank(exact, lambda name: all(term in name for term in terms), limit)
+        if len(found) < limit:
+            # 正则本身要求每个字都出现, 候选只用最少见的那个字过滤, 不再求交集;
+            # 只跳过已经列出的子串匹配, 含有全部二元组却不含子串的名字仍可能是模糊匹配
+            rarest = min((self.grams.get(ch, empty_set) for term in terms for ch in term), key=len)
+            patterns = [re.compile(".*?".join(map(re.escape, term)), re.S) for term in terms]
+            found.extend(
+                self._rank(
+                    rarest,
+                    lambda name: all(p.search(name) for p in patterns),
+                    limit - len(found),
+                    set(found),
+                    self.fuzzy_budget,
+                )
+            )
+        return found
+
+
+class AggSpec(pydantic.BaseModel):
+    func: str
+    attr: str
+    by: str = ""
+
+    @property
+    def item_name(self):
+        title = f"{self.func}({self.attr})"
+        return f"{title} 按 {self.by}" if self.by else title
+
+
+class SavedQuery(pydantic.BaseModel):
+    name: str
+    filter: str = ""
+    sorter: str = ""
+    runs: int = 0
+    last_latency: float = 0.0
+    last_size: int = 0
+
+    # 编译好的 (过滤, 排序) 函数, 常驻以免每次重新 eval
+    _plan: typing.Optional[tuple] = pydantic.PrivateAttr(None)
+
+    @property
+    def item_name(self):
+        return self.name
+
+    def describe(self):
+        return f"运行 {self.runs} 次, 上次 {self.last_latency:.1f} ms, {self.last_size} 个结果"
+
+    def plan(self):
+        if self._plan is None:
+            self._plan = compile_query(self.filter), compile_query(self.sorter)
+        return self._plan
+
+    def record(self, latency: float, size: int):
+        self.runs += 1
+        self.last_latency = latency * 1000
+        self.last_size = size
+
+
 class Data(pydantic.BaseModel):
     docs: Docs
     attrs: Attrs
     editor: str
+    aggregates: list[AggSpec] = []
+    queries: dict[str, SavedQuery] = {}
+
+    # 属性 id -> 持有该属性值的文档 id, 首次用到时建立
+    _holders: typing.Optional[dict[str, set[str]]] = pydantic.PrivateAttr(None)
+    # 规范化路径 / (设备, inode) -> 文档 id, 首次用到时建立
+    _paths: typing.Optional[dict[str, str]] = pydantic.PrivateAttr(None)
+    _inodes: typing.Optional[dict[tuple[int, int], str]] = pydantic.PrivateAttr(None)
+    _names: typing.Optional[NameIndex] = pydantic.PrivateAttr(None)
 
     @staticmethod
     def empty():
         return Data(docs={}, attrs={}, editor="notepad")
 
+    def holders(self, attr_id: str) -> set[str]:
+        if self._holders is None:
+            self._holders = {}
+            for doc in self.docs.values():
+                for each in doc.attrs:
+                    self._holders.setdefault(each, set()).add(doc.id)
+        return self._holders.setdefault(attr_id, set())
+
+    def set_value(self, doc: Document, attr_id: str, v: Value):
+        doc.attrs[attr_id] = v
+        if self._holders is not None:
+            self.holders(attr_id).add(doc.id)
+
+    def unset_value(self, doc: Document, attr_id: str):
+        doc.attrs.pop(attr_id, None)
+        if self._holders is not None:
+            self.holders(attr_id).discard(doc.id)
+
+    def add_doc(self, doc: Document):
+        self.docs[doc.id] = doc
+        if self._holders is not None:
+            for attr_id in doc.attrs:
+                self.holders(attr_id).add(doc.id)
+        if self._paths is not None:
+            self._index_path(doc)
+        if self._names is not None:
+            self._names.add(doc.id, doc.name)
+
+    def remove_doc(self, doc_id: str):
+        doc = self.docs.pop(doc_id)
+        if self._holders is not None:
+            for attr_id in doc.attrs:
+                self.holders(attr_id).discard(doc_id)
+        if self._paths is not None:
+            self._unindex_path(doc)
+        if self._names is not None:
+            self._names.remove(doc_id)
+        return doc
+
+    def rename_doc(self, doc: Document, name: str):
+        doc.name = name
+        if self._names is not None:
+            self._names.add(doc.id, name)
+
+    def name_index(self) -> NameIndex:
+        if self._names is None:
+            self._names = NameIndex()
+            for doc in self.docs.values():
+                self._names.add(doc.id, doc.name)
+        return self._names
+
+    def search_names(self, query: str, limit: int = 200) -> list[Document]:
+        return [self.docs[doc_id] for doc_id in self.name_index().search(query, limit)]
+
+    @staticmethod
+    def norm_path(path: str) -> str:
+        return os.path.normcase(os.path.realpath(path))
+
+    def _index_path(self, doc: Document):
+        self._paths[self.norm_path(doc.path)] = doc.id
+        try:
+            st = os.stat(doc.path)
+        except OSError:
+            return
+        self._inodes[st.st_dev, st.st_ino] = doc.id
+
+    def _unindex_path(self, doc: Document):
+        norm = self.norm_path(doc.path)
+        if self._paths.get(norm) == doc.id:
+            del self._paths[norm]
+
+    def doc_by_path(self, path: str) -> typing.Optional[Document]:
+        """
+        按规范化路径查找文档, 找不到时按 inode 查找(硬链接等)
+        inode 表中过期的项在查找时校验, 不单独清理
+        """
+        if self._paths is None:
+            self._paths = {}
+            self._inodes = {}
+            for doc in self.docs.values():
+                self._index_path(doc)
+        if (doc := self.docs.get(self._paths.get(self.norm_path(path)))) is not None:
+            return doc
+        try:
+            st = os.stat(path)
+            key = st.st_dev, st.st_ino
+            if (doc := self.docs.get(self._inodes.get(key))) is not None:
+                st = os.stat(doc.path)
+                if (st.st_dev, st.st_ino) == key:
+                    return doc
+        except OSError:
+            pass
+        return None
+
+    def move_doc(self, doc: Document, path: str):
+        if self._paths is not None:
+            self._unindex_path(doc)
+        doc.path = path
+        if self._paths is not None:
+            self._index_path(doc)
+
+    def remove_attr(self, attr_id: str):
+        """
+        删除属性及所有文档中该属性的值, 只访问持有该属性值的文档
+        """
+        del self.attrs[attr_id]
+        self.holders(attr_id)
+        for doc_id in self._holders.pop(attr_id):
+            if doc := self.docs.get(doc_id):
+                doc.attrs.pop(attr_id, None)
+
+    def dead_values(self) -> dict[str, int]:
+        """
+        统计已不存在的属性在文档中残留的值
+        """
+        dead = {}
+        for doc in self.docs.values():
+            for attr_id in doc.attrs:
+                if attr_id not in self.attrs:
+                    dead[attr_id] = dead.get(attr_id, 0) + 1
+        return dead
+
+    def compact(self) -> int:
+        n = 0
+        for doc in self.docs.values():
+            for attr_id in [k for k in doc.attrs if k not in self.attrs]:
+                del doc.attrs[attr_id]
+                n += 1
+        if n and self._holders is not None:
+            for attr_id in [k for k in self._holders if k not in self.attrs]:
+                del self._holders[attr_id]
+        return n
+
 
 Data.update_forward_refs()
 
@@ -107,6 +427,7 @@ class Project:
         self.datafile = datafile
 
     def save(self, data: Data):
+        data.compact()
         json.dump(
             data.dict(),
             pathlib.Path(self.datafile).absolute().open('w', encoding='utf-8'),
@@ -126,6 +447,710 @@ class Project:
         return Data(docs={}, attrs={}, editor="notepad")
 
 
+_cjk = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_cjk_char = re.compile(f"[{_cjk}]")
+_non_cjk_word = re.compile(f"[^\\W{_cjk}]+")
+_blank = re.compile(r"\s")
+
+
+def content_hash(raw: bytes) -> str:
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def content_stats(path: str, known_hash: str = "") -> typing.Optional[dict]:
+    """
+    统计文档内容: 字数(不含空白), 词数(每个汉字算一词), 行数
+    内容哈希与 known_hash 相同时只返回哈希
+    """
+    try:
+        raw = pathlib.Path(path).read_bytes()
+    except OSError:
+        return None
+    digest = content_hash(raw)
+    if digest == known_hash:
+        return dict(hash=digest)
+    text = raw.decode("utf-8", errors="replace")
+    return dict(
+        hash=digest,
+        chars=len(text) - len(_blank.findall(text)),
+        words=len(_cjk_char.findall(text)) + len(_non_cjk_word.findall(text)),
+        lines=text.count("\n") + (1 if text and not text.endswith("\n") else 0),
+    )
+
+
+class StatEntry(pydantic.BaseModel):
+    mtime: float
+    size: int
+    hash: str
+    chars: int
+    words: int
+    lines: int
+    dev: int = 0
+    ino: int = 0
+
+
+class ContentStats:
+    """
+    文档内容的内置统计属性, 以 <大纲文件>.stats.json 作缓存
+    只有路径、修改时间、大小或内容哈希变化的文档会被重新统计
+    """
+    names = {"字数": "chars", "词数": "words", "行数": "lines", "修改时间": "mtime"}
+    # 子进程以 spawn 方式启动, 开销较大, 待统计的文档足够多时才值得
+    parallel_threshold = 256
+
+    def __init__(self, datafile: typing.Optional[str]):
+        self.datafile = datafile
+        self.entries: dict[str, StatEntry] = {}
+        # 文件已不存在的文档的最后统计, 用于寻找被移动的文件
+        self.missing: dict[str, StatEntry] = {}
+        self.lock = threading.Lock()
+        if datafile and os.path.exists(self.sidecar):
+            try:
+                raw = json.load(open(self.sidecar, mode="r", encoding='utf-8'))
+                self.entries = {k: StatEntry.parse_obj(v) for k, v in raw.items()}
+            except (json.JSONDecodeError, pydantic.ValidationError):
+                self.entries = {}
+
+    @staticmethod
+    def key(path: str):
+        return os.path.normcase(os.path.abspath(path))
+
+    @property
+    def sidecar(self):
+        return f"{self.datafile}.stats.json"
+
+    @classmethod
+    def mentioned(cls, *codes: str):
+        return any(name in code for code in codes for name in cls.names)
+
+    def value(self, path: str, name: str):
+        entry = self.entries.get(self.key(path))
+        if entry is None:
+            return None
+        return getattr(entry, self.names[name])
+
+    def refresh(self, paths: typing.Iterable[str]) -> set[str]:
+        """
+        重新统计有变化的文档, 返回统计结果变化了的路径
+        读取和统计文件时不持有锁, 只在查看与写回缓存时短暂持有
+        """
+        changed = set()
+        stale: list[tuple[str, os.stat_result]] = []
+        with self.lock:
+            for path in set(paths):
+                key = self.key(path)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    if (entry := self.entries.pop(key, None)) is not None:
+                        self.missing[key] = entry
+                        changed.add(path)
+                    continue
+                entry = self.entries.get(key)
+                if entry and entry.mtime == st.st_mtime and entry.size == st.st_size:
+                    continue
+                stale.append((path, st))
+            args = [
+                (path, getattr(self.entries.get(self.key(path)), "hash", ""))
+                for path, _ in stale
+            ]
+
+        if not stale:
+            return changed
+
+        if len(stale) < self.parallel_threshold:
+            results = [content_stats(*a) for a in args]
+        else:
+            # 可能在 QThread 中调用, fork 出的子进程会带着 Qt 的线程状态
+            with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as pool:
+                results = list(
+                    pool.map(
+                        content_stats,
+                        *zip(*args),
+                        chunksize=max(1, len(stale) // (4 * (os.cpu_count() or 1))),
+                    )
+                )
+
+        with self.lock:
+            return self._apply(stale, results, changed)
+
+    def _apply(self, stale: list[tuple[str, os.stat_result]], results: list, changed: set[str]) -> set[str]:
+        for (path, st), result in zip(stale, results):
+            key = self.key(path)
+            if result is None:
+                self.entries.pop(key, None)
+                changed.add(path)
+                continue
+            old = self.entries.get(key)
+            if len(result) == 1:
+                if old is None or old.hash != result["hash"]:
+                    # 统计期间缓存已被另一次刷新改动, 留给下一次刷新
+                    continue
+                entry = old.copy(update=dict(mtime=st.st_mtime, size=st.st_size))
+            else:
+                entry = StatEntry(mtime=st.st_mtime, size=st.st_size, **result)
+            entry.dev, entry.ino = st.st_dev, st.st_ino
+            self.entries[key] = entry
+            changed.add(path)
+
+        self.save()
+        return changed
+
+    def save(self):
+        if not self.datafile:
+            return
+        json.dump(
+            {k: v.dict() for k, v in self.entries.items()},
+            pathlib.Path(self.sidecar).absolute().open('w', encoding='utf-8'),
+            ensure_ascii=False,
+        )
+
+
+class _Group:
+    __slots__ = ("count", "numbers", "total", "values")
+
+    def __init__(self):
+        self.count = 0
+        self.numbers = 0
+        self.total = 0
+        self.values = {}
+
+    def add(self, v):
+        self.count += 1
+        if isinstance(v, (int, float)):
+            self.numbers += 1
+            self.total += v
+            self.values[v] = self.values.get(v, 0) + 1
+
+    def discard(self, v):
+        self.count -= 1
+        if isinstance(v, (int, float)):
+            self.numbers -= 1
+            self.total -= v
+            if n := self.values[v] - 1:
+                self.values[v] = n
+            else:
+                del self.values[v]
+
+
+class Aggregate:
+    """
+    增量维护的分组统计
+    每个文档的贡献单独记录, 文档变化时只撤销旧贡献再计入新贡献
+    """
+    funcs = {
+        "求和": lambda g: g.total,
+        "计数": lambda g: g.count,
+        "最小值": lambda g: min(g.values, default=None),
+        "最大值": lambda g: max(g.values, default=None),
+        "平均值": lambda g: g.total / g.numbers if g.numbers else None,
+    }
+
+    def __init__(self, spec: AggSpec, data: Data, stats: typing.Optional[ContentStats] = None):
+        if spec.func not in self.funcs:
+            raise ValueError(f"未知的统计函数: {spec.func}")
+        self.spec = spec
+        self.data = data
+        self.stats = stats
+        self.attr_lookup = {}
+        self.groups: dict[typing.Any, _Group] = {}
+        self.contrib: dict[str, tuple[typing.Any, Value]] = {}
+        for doc in data.docs.values():
+            self.update(doc)
+
+    def update(self, doc: Document):
+        self.discard(doc.id)
+        proxy = QueryProxy(doc, self.data.attrs, self.attr_lookup, self.stats)
+        v = getattr(proxy, self.spec.attr)
+        if v is None:
+            return
+        key = getattr(proxy, self.spec.by) if self.spec.by else None
+        if (group := self.groups.get(key)) is None:
+            group = self.groups[key] = _Group()
+        group.add(v)
+        self.contrib[doc.id] = key, v
+
+    def discard(self, doc_id: str):
+        if (kv := self.contrib.pop(doc_id, None)) is None:
+            return
+        key, v = kv
+        group = self.groups[key]
+        group.discard(v)
+        if not group.count:
+            del self.groups[key]
+
+    def results(self) -> list[tuple[typing.Any, typing.Any]]:
+        f = self.funcs[self.spec.func]
+        rows = [(k, f(g)) for k, g in self.groups.items()]
+        rows.sort(key=lambda kv: (kv[0] is None, str(kv[0])))
+        return rows
+
+
+class Aggregates:
+    def __init__(self, data: Data, stats: typing.Optional[ContentStats] = None):
+        self.data = data
+        self.stats = stats
+        self.rebuild()
+
+    def rebuild(self):
+        self.items = [Aggregate(spec, self.data, self.stats) for spec in self.data.aggregates]
+
+    def uses_stats(self):
+        return any(
+            ContentStats.mentioned(spec.attr, spec.by) for spec in self.data.aggregates
+        )
+
+    def add(self, spec: AggSpec):
+        item = Aggregate(spec, self.data, self.stats)
+        self.data.aggregates.append(spec)
+        self.items.append(item)
+        return item
+
+    def remove(self, item: Aggregate):
+        self.data.aggregates.remove(item.spec)
+        self.items.remove(item)
+
+    def update(self, doc: Document):
+        for each in self.items:
+            each.update(doc)
+
+    def discard(self, doc_id: str):
+        for each in self.items:
+            each.discard(doc_id)
+
+
+@lru_cache(maxsize=256)
+def compile_query(code: str):
+    """
+    把「过滤」「排序」中的表达式编译为以 _ 为参数的函数
+    同样的表达式只编译一次
+    """
+    if code := code.strip():
+        return eval(f"lambda _: {code}")
+    return None
+
+
+def export_columns(data: Data) -> list[str]:
+    return ["名字", "文件路径", *(attr.name for attr in data.attrs.values())]
+
+
+def export_rows(docs: typing.Iterable[Document], data: Data) -> typing.Iterator[list]:
+    attr_ids = list(data.attrs)
+    for doc in docs:
+        yield [doc.name, doc.path, *(doc.attrs.get(attr_id) for attr_id in attr_ids)]
+
+
+def csv_lines(columns: list[str], rows: typing.Iterable[list]) -> typing.Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(columns)
+    yield buf.getvalue()
+    for row in rows:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(["" if v is None else v for v in row])
+        yield buf.getvalue()
+
+
+def jsonl_lines(columns: list[str], rows: typing.Iterable[list]) -> typing.Iterator[str]:
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n"
+
+
+def _md_cell(v) -> str:
+    if v is None:
+        return ""
+    return str(v).replace("\\", "\\\\").replace("|", "\\|").replace("\n", "<br>")
+
+
+def markdown_lines(columns: list[str], rows: typing.Iterable[list]) -> typing.Iterator[str]:
+    yield "| " + " | ".join(map(_md_cell, columns)) + " |\n"
+    yield "|" + "---|" * len(columns) + "\n"
+    for row in rows:
+        yield "| " + " | ".join(map(_md_cell, row)) + " |\n"
+
+
+exporters = {"csv": csv_lines, "jsonl": jsonl_lines, "md": markdown_lines}
+
+
+def export_docs(docs: typing.Iterable[Document], data: Data, fmt: str, out: typing.TextIO):
+    """
+    以流的方式导出文档, 逐行写入 out, 不在内存中拼出整个结果
+    """
+    try:
+        lines = exporters[fmt]
+    except KeyError:
+        raise ValueError(f"不支持的导出格式: {fmt}") from None
+    for line in lines(export_columns(data), export_rows(docs, data)):
+        out.write(line)
+
+
+_boms = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+
+def sniff_encoding(head: bytes) -> str:
+    for bom, encoding in _boms:
+        if head.startswith(bom):
+            return encoding
+    for encoding in ("utf-8", "gb18030"):
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    return "latin-1"
+
+
+def read_preview(path: str, max_chars: int = 8000, chunk: int = 4096) -> str:
+    """
+    通过内存映射读取文档开头, 边解码边截断, 不读入整个文件
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            decoder = codecs.getincrementaldecoder(sniff_encoding(mm[:chunk]))(errors="replace")
+            parts = []
+            n = 0
+            for i in range(0, len(mm), chunk):
+                part = decoder.decode(mm[i:i + chunk])
+                parts.append(part)
+                n += len(part)
+                if n >= max_chars:
+                    break
+            else:
+                parts.append(decoder.decode(b"", final=True))
+    return "".join(parts)[:max_chars]
+
+
+class PreviewCache:
+    """
+    文档预览的 LRU 缓存, 以修改时间与大小校验, 总占用不超过 budget 字节
+    """
+
+    def __init__(self, budget: int = 16 * 1024 * 1024):
+        self.budget = budget
+        self.used = 0
+        self.entries: OrderedDict[str, tuple[tuple[int, int], str]] = OrderedDict()
+
+    def get(self, path: str) -> str:
+        st = os.stat(path)
+        stamp = st.st_mtime_ns, st.st_size
+        if (entry := self.entries.get(path)) is not None:
+            if entry[0] == stamp:
+                self.entries.move_to_end(path)
+                return entry[1]
+            self._drop(path)
+        text = read_preview(path)
+        self.entries[path] = stamp, text
+        self.used += sys.getsizeof(text)
+        while self.used > self.budget and len(self.entries) > 1:
+            self._drop(next(iter(self.entries)))
+        return text
+
+    def _drop(self, path: str):
+        _, text = self.entries.pop(path)
+        self.used -= sys.getsizeof(text)
+
+
+def find_moved(
+    docs: list[Document], stats: ContentStats, roots: list[str]
+) -> dict[str, str]:
+    """
+    为文件已不存在的文档在 roots 下寻找新位置
+    先按统计缓存中记下的 inode 匹配, 再按大小与内容哈希匹配
+    哈希匹配只接受一一对应: 该哈希只属于一个缺失文档, 且 roots 下只有一个文件与之相同;
+    空文件不参与哈希匹配. 其余留给手动重新关联
+    返回 文档 id -> 新路径
+    """
+    known = set()
+    by_inode: dict[tuple[int, int], Document] = {}
+    by_size: dict[int, dict[str, list[Document]]] = {}
+    for doc in docs:
+        if os.path.exists(doc.path):
+            known.add(Data.norm_path(doc.path))
+            continue
+        key = stats.key(doc.path)
+        if (entry := stats.entries.get(key) or stats.missing.get(key)) is None:
+            continue
+        if entry.ino:
+            by_inode[entry.dev, entry.ino] = doc
+        if entry.size:
+            by_size.setdefault(entry.size, {}).setdefault(entry.hash, []).append(doc)
+
+    moved: dict[str, str] = {}
+    n = len({doc.id for each in by_size.values() for ds in each.values() for doc in ds} | {doc.id for doc in by_inode.values()})
+    if not n:
+        return moved
+    found: dict[str, list[str]] = {}
+    for root in roots:
+        for dirpath, _, files in os.walk(root):
+            for name in files:
+                if len(moved) == n:
+                    return moved
+                path = os.path.join(dirpath, name)
+                if Data.norm_path(path) in known:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                doc = by_inode.get((st.st_dev, st.st_ino))
+                if doc is not None:
+                    if doc.id not in moved:
+                        moved[doc.id] = path
+                        known.add(Data.norm_path(path))
+                    continue
+                if candidates := by_size.get(st.st_size):
+                    try:
+                        digest = content_hash(pathlib.Path(path).read_bytes())
+                    except OSError:
+                        continue
+                    if digest in candidates:
+                        found.setdefault(digest, []).append(path)
+    for size, candidates in by_size.items():
+        for digest, ds in candidates.items():
+            paths = [path for path in found.get(digest, ()) if Data.norm_path(path) not in known]
+            if len(ds) == 1 and len(paths) == 1 and ds[0].id not in moved:
+                moved[ds[0].id] = paths[0]
+    return moved
+
+
+def _query_worker(conn, cancel):
+    """
+    查询进程: 持有分到的一部分文档的副本, 按消息增量更新, 并对这部分文档执行过滤与排序
+    """
+    docs: dict[str, tuple[int, Document]] = {}
+    attrs: Attrs = {}
+    attr_lookup = {}
+    stats = ContentStats(None)
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        kind = msg[0]
+        if kind == "put":
+            for seq, doc in msg[1]:
+                docs[doc.id] = seq, doc
+        elif kind == "drop":
+            for doc_id in msg[1]:
+                docs.pop(doc_id, None)
+        elif kind == "attrs":
+            attrs = msg[1]
+            attr_lookup = {}
+        elif kind == "stats":
+            for key, entry in msg[1].items():
+                if entry is None:
+                    stats.entries.pop(key, None)
+                else:
+                    stats.entries[key] = entry
+        elif kind == "query":
+            result = _query_shard(docs, attrs, attr_lookup, stats, msg[1], msg[2], cancel)
+            try:
+                conn.send(result)
+            except Exception as e:
+                conn.send(("error", "排序", f"排序键无法传回: {e}"))
+        elif kind == "close":
+            return
+
+
+def _query_shard(docs, attrs, attr_lookup, stats, filter_code, sorter_code, cancel):
+    F = compile_query(filter_code)
+    S = compile_query(sorter_code)
+    out = []
+    for i, (seq, doc) in enumerate(docs.values()):
+        if i % 256 == 0 and cancel.is_set():
+            return ("cancelled",)
+        proxy = QueryProxy(doc, attrs, attr_lookup, stats)
+        try:
+            if F and not F(proxy):
+                continue
+        except Exception as e:
+            return ("error", "过滤", str(e))
+        try:
+            out.append((S(proxy), seq, doc.id) if S else (seq, doc.id))
+        except Exception as e:
+            return ("error", "排序", str(e))
+    try:
+        out.sort()
+    except TypeError as e:
+        return ("error", "排序", str(e))
+    return ("ok", out)
+
+
+class QueryPool:
+    """
+    在多个进程中并行执行过滤与排序
+    文档按加入顺序轮流分给各进程, 每个进程常驻自己那部分文档的副本, 改动时只发送变化的部分
+    进程由 start 在后台线程中启动并载入, 在此之前的改动先排队, 载入完成后按顺序发出
+    """
+
+    batch_size = 1000
+
+    def __init__(self, n: typing.Optional[int] = None):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.cancel = self.ctx.Event()
+        self.lock = threading.Lock()
+        self.n = n or os.cpu_count() or 1
+        self.seqs: dict[str, int] = {}
+        self.conns = []
+        self.procs = []
+        self.backlog: typing.Optional[list] = []
+        self.building = False
+        self.closed = False
+
+    @property
+    def ready(self) -> bool:
+        return self.backlog is None
+
+    def start(self, docs: list[Document], attrs: Attrs, stats: ContentStats) -> bool:
+        """
+        启动各进程并载入文档快照, 在后台线程中调用
+        文档分批发送, 以免长时间占住 GIL; 中途被取消或关闭时返回 False, 此时进程池不可再用
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            self.building = True
+        try:
+            for _ in range(self.n):
+                conn, child = self.ctx.Pipe()
+                proc = self.ctx.Process(target=_query_worker, args=(child, self.cancel), daemon=True)
+                proc.start()
+                self.conns.append(conn)
+                self.procs.append(proc)
+                if self.closed:
+                    return False
+            # 载入期间别的线程只往 backlog 里排队, 这里发送不必持锁,
+            # 以免进程还没开始读管道时把界面线程堵在锁上
+            for conn in self.conns:
+                conn.send(("attrs", dict(attrs)))
+            with stats.lock:
+                entries = dict(stats.entries)
+            if entries:
+                for conn in self.conns:
+                    conn.send(("stats", entries))
+            for k in range(0, len(docs), self.batch_size):
+                if self.closed or self.cancel.is_set():
+                    return False
+                for conn, shard in zip(self.conns, self._shard(docs[k:k + self.batch_size])):
+                    if shard:
+                        conn.send(("put", shard))
+            while True:
+                with self.lock:
+                    pending, self.backlog = self.backlog, []
+                    if not pending:
+                        self.backlog = None
+                        return True
+                for i, msg in pending:
+                    self.conns[i].send(msg)
+        except OSError:
+            # 进程启动失败或中途退出
+            return False
+        finally:
+            with self.lock:
+                self.building = False
+                closed = self.closed
+            if closed:
+                self._shutdown()
+
+    def _send(self, i: int, msg):
+        with self.lock:
+            if self.backlog is not None:
+                self.backlog.append((i, msg))
+            else:
+                self.conns[i].send(msg)
+
+    def _broadcast(self, msg):
+        for i in range(self.n):
+            self._send(i, msg)
+
+    def _shard(self, docs: typing.Iterable[Document]) -> list[list[tuple[int, Document]]]:
+        shards = [[] for _ in range(self.n)]
+        with self.lock:
+            for doc in docs:
+                if (seq := self.seqs.get(doc.id)) is None:
+                    seq = self.seqs[doc.id] = len(self.seqs)
+                shards[seq % self.n].append((seq, doc))
+        return shards
+
+    def put(self, docs: typing.Iterable[Document]):
+        for i, shard in enumerate(self._shard(docs)):
+            if shard:
+                self._send(i, ("put", shard))
+
+    def drop(self, doc_ids: typing.Iterable[str]):
+        shards = [[] for _ in range(self.n)]
+        for doc_id in doc_ids:
+            if (seq := self.seqs.get(doc_id)) is not None:
+                shards[seq % len(shards)].append(doc_id)
+        for i, shard in enumerate(shards):
+            if shard:
+                self._send(i, ("drop", shard))
+
+    def set_attrs(self, attrs: Attrs):
+        self._broadcast(("attrs", dict(attrs)))
+
+    def set_stats(self, entries: dict[str, typing.Optional[StatEntry]]):
+        if entries:
+            self._broadcast(("stats", entries))
+
+    def query(self, filter_code: str, sorter_code: str) -> tuple:
+        """
+        阻塞直到各进程返回, 返回 ("ok", 文档 id 列表), ("error", 阶段, 信息) 或 ("cancelled",)
+        调用方须在发起查询前清除 cancel, 以免清掉查询开始前就发出的取消
+        """
+        try:
+            self._broadcast(("query", filter_code, sorter_code))
+            results = [conn.recv() for conn in self.conns]
+        except (EOFError, OSError):
+            # 进程池在查询途中被关闭
+            return ("cancelled",)
+        for result in results:
+            if result[0] != "ok":
+                return result
+        shards = [result[1] for result in results]
+        try:
+            merged = list(heapq.merge(*shards))
+        except TypeError as e:
+            return ("error", "排序", str(e))
+        return ("ok", [each[-1] for each in merged])
+
+    def close(self):
+        """
+        通知各进程退出, 等待与强行结束放在后台线程, 不阻塞调用方
+        仍在载入时由 start 在停下后收尾
+        """
+        self.cancel.set()
+        with self.lock:
+            self.closed = True
+            if self.building:
+                return
+        self._shutdown()
+
+    def _shutdown(self):
+        for conn in self.conns:
+            try:
+                conn.send(("close",))
+            except OSError:
+                pass
+        threading.Thread(target=self._reap, daemon=True).start()
+
+    def _reap(self):
+        for proc in self.procs:
+            proc.join(1)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        for conn in self.conns:
+            conn.close()
+
+
 T = typing.TypeVar("T")
 
 
@@ -353,13 +1378,9 @@ class DocAttrs(DList):
     def remove(self, w: typing.Union[DListItem[Attr], Datum[Attr]]):
         if isinstance(w, DListItem):
             w = w.datum
-        del self.main.data.attrs[w.v.id]
+        self.main.data.remove_attr(w.v.id)
         super().remove(w)
-
-    def clear(self):
-        for each in self.data:
-            del self.main.data.attrs[each.v.id]
-        super().clear()
+        self.main.attrs_changed()
 
 
 def unparse_type(t: type):
@@ -385,9 +1406,10 @@ def parse_type(s: str):
 
 
 class ChangeDocAttr(QDialog):
-    def __init__(self, obj: Datum[Document], glob_attrs: dict[str, Attr]):
+    def __init__(self, obj: Datum[Document], data: Data):
         super().__init__(*empty_seq)
-        self.glob_attrs = glob_attrs
+        glob_attrs = self.glob_attrs = data.attrs
+        self.data = data
         self.obj = obj
         obj_attrs = obj.v.attrs
         self.setWindowTitle("文档属性修改器")
@@ -436,7 +1458,7 @@ class ChangeDocAttr(QDialog):
         not_added_attrs = set(glob_attrs.keys())
         for attr_id in list(obj_attrs.keys()):
             if attr_id not in glob_attrs:
-                del obj_attrs[attr_id]
+                data.unset_value(obj.v, attr_id)
                 continue
 
             add_field(attr_id, obj_attrs[attr_id])
@@ -491,17 +1513,16 @@ class ChangeDocAttr(QDialog):
 
     def enter(self):
         obj = self.obj
-        obj_attrs = obj.v.attrs
         for f in self.funcs:
             kv = f()
             if kv is None:
                 continue
-            k, v = f()
+            k, v = kv
             if v is None:
-                del obj_attrs[k]
+                self.data.unset_value(obj.v, k)
             else:
-                obj_attrs[k] = v
-        obj.v.name = self.register_name_input.text().strip() or obj.v.name
+                self.data.set_value(obj.v, k, v)
+        self.data.rename_doc(obj.v, self.register_name_input.text().strip() or obj.v.name)
         obj.notify()
         self.close()
 
@@ -622,12 +1643,547 @@ class DInputAttr(QDialog):
         self.close()
 
 
+class DInputAgg(QDialog):
+    def __init__(self, ref: Datum, glob_attrs: Attrs):
+        super().__init__(*empty_seq)
+        self.ref = ref
+        self.setWindowTitle("统计添加器")
+        self.layout = QFormLayout()
+
+        names = ["名字", *ContentStats.names, *(a.name for a in glob_attrs.values())]
+        attr_picker = QComboBox()
+        attr_picker.setEditable(True)
+        attr_picker.addItems(names)
+        func_picker = QComboBox()
+        func_picker.addItems(list(Aggregate.funcs))
+        by_picker = QComboBox()
+        by_picker.setEditable(True)
+        by_picker.addItems(["", *names])
+        enter = QPushButton("确定")
+
+        proper_sized(enter)
+        self.layout.addRow("属性", attr_picker)
+        self.layout.addRow("统计", func_picker)
+        self.layout.addRow("分组", by_picker)
+        self.layout.addWidget(enter)
+
+        self.setLayout(self.layout)
+        self.setFixedSize(self.sizeHint())
+        self.layout.setSpacing(5)
+        self.layout.setContentsMargins(2, 2, 2, 2)
+
+        self.attr_picker = attr_picker
+        self.func_picker = func_picker
+        self.by_picker = by_picker
+
+        connect(enter.clicked, self.enter)
+        self.move(QCursor.pos())
+
+    def enter(self):
+        attr = self.attr_picker.currentText().strip()
+        if not attr:
+            return
+        self.ref.v = AggSpec(
+            func=self.func_picker.currentText(),
+            attr=attr,
+            by=self.by_picker.currentText().strip(),
+        )
+        self.close()
+
+
+class AggregatePane(QTreeWidget):
+    def __init__(self, main: Main):
+        super().__init__()
+        self.main = main
+        self.setWindowTitle("统计")
+        self.setHeaderLabels(["分组", "值"])
+        self.setMinimumWidth(300)
+        self.setMinimumHeight(200)
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        connect(self.customContextMenuRequested, self.right_click)
+
+    def showEvent(self, e):
+        super().showEvent(e)
+        if self.main.aggregates.uses_stats():
+            self.main.refresh_stats()
+        self.sync()
+
+    def sync(self):
+        if not self.isVisible():
+            return
+        self.clear()
+        for item in self.main.aggregates.items:
+            top = QTreeWidgetItem(self, [item.spec.item_name, ""])
+            for k, v in item.results():
+                if isinstance(v, float):
+                    v = round(v, 2)
+                QTreeWidgetItem(top, ["(无)" if k is None else str(k), str(v)])
+        self.expandAll()
+
+    def right_click(self, pos):
+        popMenu = QMenu(self)
+        popMenu.addAction("添加统计", self.main.add_aggregate)
+        top = self.itemAt(pos)
+        while top is not None and top.parent() is not None:
+            top = top.parent()
+        if top is not None:
+            item = self.main.aggregates.items[self.indexOfTopLevelItem(top)]
+            popMenu.addAction("删除统计", partial(self.main.remove_aggregate, item))
+        popMenu.exec_(self.cursor().pos())
+
+
+class BulkEditAttr(QDialog):
+    ops = ("设置", "清除", "增加")
+
+    def __init__(self, ref: Datum, glob_attrs: Attrs, n: int):
+        super().__init__(*empty_seq)
+        self.ref = ref
+        self.glob_attrs = glob_attrs
+        self.attr_ids = list(glob_attrs)
+        self.setWindowTitle(f"批量修改 {n} 个文档")
+        self.layout = QFormLayout()
+
+        attr_picker = QComboBox()
+        attr_picker.addItems([glob_attrs[attr_id].name for attr_id in self.attr_ids])
+        op_picker = QComboBox()
+        op_picker.addItems(list(self.ops))
+        value_input = QLineEdit(self)
+        enter = QPushButton("确定")
+
+        proper_sized(enter)
+        self.layout.addRow("属性", attr_picker)
+        self.layout.addRow("操作", op_picker)
+        self.layout.addRow("值", value_input)
+        self.layout.addWidget(enter)
+
+        self.setLayout(self.layout)
+        self.setFixedSize(self.sizeHint())
+        self.layout.setSpacing(5)
+        self.layout.setContentsMargins(2, 2, 2, 2)
+
+        self.attr_picker = attr_picker
+        self.op_picker = op_picker
+        self.value_input = value_input
+
+        connect(op_picker.currentTextChanged, lambda op: value_input.setEnabled(op != "清除"))
+        connect(enter.clicked, self.enter)
+        self.move(QCursor.pos())
+
+    def enter(self):
+        if (i := self.attr_picker.currentIndex()) < 0:
+            return
+        attr = self.glob_attrs[self.attr_ids[i]]
+        op = self.op_picker.currentText()
+        v = None
+        if op != "清除":
+            typ = parse_type(attr.typ)
+            text = self.value_input.text()
+            try:
+                v = typ(text)
+            except ValueError:
+                msg_box = QMessageBox()
+                msg_box.setText(
+                    f"属性「{attr.name}」要求类型{unparse_type(typ)}: {text}"
+                )
+                msg_box.exec_()
+                return
+        self.ref.v = attr, op, v
+        self.close()
+
+
+_missing = object()
+
+
+class AttrEditCommand(QUndoCommand):
+    """
+    对多个文档同一属性的修改, 作为一步撤销
+    changes 中每一项为 (文档, 旧值, 新值), 值为 _missing 表示没有该属性
+    """
+
+    def __init__(self, main: Main, attr_id: str, changes: list, text: str):
+        super().__init__(text)
+        self.main = main
+        self.attr_id = attr_id
+        self.changes = changes
+
+    def apply(self, index: int):
+        attr_id = self.attr_id
+        data = self.main.data
+        for change in self.changes:
+            doc, v = change[0], change[index]
+            if v is _missing:
+                data.unset_value(doc, attr_id)
+            else:
+                data.set_value(doc, attr_id, v)
+        self.main.docs_changed([change[0] for change in self.changes])
+
+    def redo(self):
+        self.apply(2)
+
+    def undo(self):
+        self.apply(1)
+
+
+def reconcile_roots(datafile: str, docs: list[Document], manual: bool = False) -> list[str]:
+    """
+    大纲文件所在目录; 手动重新关联时还包括各文档所在目录, 去掉互相包含的
+    """
+    roots = {os.path.dirname(os.path.abspath(datafile))}
+    if manual:
+        roots.update(os.path.dirname(os.path.abspath(doc.path)) for doc in docs)
+    result = []
+    for root in sorted(roots):
+        if any(root == each or root.startswith(each.rstrip(os.sep) + os.sep) for each in result):
+            continue
+        if os.path.isdir(root):
+            result.append(root)
+    return result
+
+
+class ReconcileThread(QThread):
+    relinked = pyqtSignal(object)
+    refreshed = pyqtSignal(object)
+
+    def __init__(self, docs: list[Document], stats: ContentStats, roots: list[str]):
+        super().__init__()
+        self.docs = docs
+        self.stats = stats
+        self.roots = roots
+
+    def run(self):
+        moved = find_moved(self.docs, self.stats, self.roots)
+        self.relinked.emit(moved)
+        # 记下现有文档的 inode 与哈希, 以便以后追踪
+        self.refreshed.emit(self.stats.refresh(doc.path for doc in self.docs if doc.id not in moved))
+
+
+class ParallelQueryThread(QThread):
+    done = pyqtSignal(object)
+
+    def __init__(
+        self,
+        pool: QueryPool,
+        filter_code: str,
+        sorter_code: str,
+        data: Data,
+        stats: ContentStats,
+    ):
+        super().__init__()
+        self.pool = pool
+        self.filter_code = filter_code
+        self.sorter_code = sorter_code
+        self.docs = self.attrs = None
+        if not pool.ready:
+            # 快照在界面线程中取, 载入期间的改动由进程池排队
+            self.docs = list(data.docs.values())
+            self.attrs = dict(data.attrs)
+        self.stats = stats
+
+    def run(self):
+        if self.docs is not None and not self.pool.start(self.docs, self.attrs, self.stats):
+            self.done.emit(("cancelled",))
+            return
+        self.done.emit(self.pool.query(self.filter_code, self.sorter_code))
+
+
+class ExportThread(QThread):
+    failed = pyqtSignal(str)
+
+    def __init__(self, docs: list[Document], data: Data, fmt: str, path: str):
+        super().__init__()
+        self.docs = docs
+        self.data = data
+        self.fmt = fmt
+        self.path = path
+
+    def run(self):
+        try:
+            with open(self.path, "w", encoding="utf-8", newline="") as out:
+                export_docs(self.docs, self.data, self.fmt, out)
+        except (OSError, ValueError) as e:
+            self.failed.emit(str(e))
+
+
+class DocPreview(QPlainTextEdit):
+    def __init__(self):
+        super().__init__()
+        self.cache = PreviewCache()
+        self.setReadOnly(True)
+        self.setWindowTitle("预览")
+        self.setMinimumWidth(400)
+        self.setMinimumHeight(300)
+
+    def preview(self, doc: Document):
+        self.setWindowTitle(f"预览: {doc.name}")
+        try:
+            text = self.cache.get(doc.path)
+        except OSError as e:
+            text = f"无法读取文档 {doc.path}: {e}"
+        self.setPlainText(text)
+
+
+_json_ws = re.compile(r"[ \t\n\r]*")
+
+
+class _JSONStream:
+    """
+    从文件中逐块读出 JSON 文本, 每次只解析一个值, 只保留尚未解析的部分
+    不会一次解码、拼接或解析整个文件, 每一步只短暂占用 GIL
+    """
+    decoder = json.JSONDecoder()
+    # 单个值最大的长度, 超过仍解析不出时按格式错误处理, 以免把整个文件读进来重试
+    max_value = 64 * 1024 * 1024
+
+    def __init__(self, f: typing.BinaryIO, block: int):
+        self.f = f
+        self.block = block
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.i = 0
+        self.read = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        raw = self.f.read(self.block)
+        self.read += len(raw)
+        self.eof = not raw
+        self.text = self.text[self.i:] + self.utf8.decode(raw, final=self.eof)
+        self.i = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        跳过空白, 返回下一个字符, 到结尾时返回空串
+        """
+        while True:
+            self.i = _json_ws.match(self.text, self.i).end()
+            if self.i < len(self.text) or not self.fill():
+                return self.text[self.i:self.i + 1]
+
+    def expect(self, c: str):
+        if self.peek() != c:
+            raise json.JSONDecodeError(f"此处应为 {c!r}", self.text, self.i)
+        self.i += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                v, end = self.decoder.raw_decode(self.text, self.i)
+            except json.JSONDecodeError:
+                # 值可能被块的边界截断
+                if len(self.text) - self.i < self.max_value and self.fill():
+                    continue
+                raise
+            # 数字在块的边界处可能只读到一半
+            if end == len(self.text) and self.fill():
+                continue
+            self.i = end
+            return v
+
+
+class LoadThread(QThread):
+    """
+    在后台读取并解析大纲: 先发出不含文档的大纲, 再分批发出文档
+    """
+    header = pyqtSignal(object, object)
+    chunk = pyqtSignal(object)
+    progress = pyqtSignal(int)
+    failed = pyqtSignal(str)
+    read_size = 1 << 20
+    chunk_size = 200
+
+    def __init__(self, datafile: str):
+        super().__init__()
+        self.datafile = datafile
+        self.stamp = file_stamp(datafile)
+        self.outline: typing.Optional[Outline] = None
+        self.error: typing.Optional[str] = None
+
+    def run(self):
+        try:
+            self.load()
+        except (OSError, ValueError, pydantic.ValidationError) as e:
+            self.failed.emit(str(e))
+
+    def load(self):
+        raw = None
+        if os.path.exists(self.datafile):
+            size = max(1, os.path.getsize(self.datafile))
+            with open(self.datafile, "rb") as f:
+                try:
+                    raw = self.parse(_JSONStream(f, self.read_size), size)
+                except json.JSONDecodeError:
+                    raw = None
+            if self.isInterruptionRequested():
+                return
+
+        header, docs = raw if raw is not None else ({}, [])
+        data = Data.parse_obj(dict(header, docs={})) if raw is not None else Data.empty()
+        self.header.emit(data, ContentStats(self.datafile))
+
+        chunk = []
+        for i, each in enumerate(docs, 1):
+            chunk.append(Document.parse_obj(each))
+            if len(chunk) == self.chunk_size:
+                if self.isInterruptionRequested():
+                    return
+                self.chunk.emit(chunk)
+                chunk = []
+                self.progress.emit(60 + 40 * i // len(docs))
+        if chunk:
+            self.chunk.emit(chunk)
+        self.progress.emit(100)
+
+    def parse(self, stream: _JSONStream, size: int) -> typing.Optional[tuple[dict, list[dict]]]:
+        """
+        边读边解析大纲, 返回 (除文档外的字段, 各文档的原始字典); 被中断时返回 None
+        文档逐个解析, 其间检查中断并按已读的字节数报告进度
+        """
+        header: dict = {}
+        docs: list[dict] = []
+
+        def members(value) -> bool:
+            # 解析 {键: 值, ...}, 每个值交给 value(键) 解析
+            stream.expect("{")
+            if stream.peek() == "}":
+                stream.i += 1
+                return True
+            while True:
+                key = stream.value()
+                stream.expect(":")
+                if not value(key):
+                    return False
+                if stream.peek() == "}":
+                    stream.i += 1
+                    return True
+                stream.expect(",")
+
+        def doc(_) -> bool:
+            docs.append(stream.value())
+            if len(docs) % self.chunk_size == 0:
+                if self.isInterruptionRequested():
+                    return False
+                self.progress.emit(60 * stream.read // size)
+            return True
+
+        def field(key) -> bool:
+            if key == "docs" and stream.peek() == "{":
+                return members(doc)
+            header[key] = stream.value()
+            return True
+
+        if not members(field):
+            return None
+        if stream.peek():
+            raise json.JSONDecodeError("多余的内容", stream.text, stream.i)
+        return header, docs
+
+
+def file_stamp(path: str) -> typing.Optional[tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class Outline:
+    """
+    工作区中常驻的一份大纲: 数据、内容统计、分组统计以及已经建好的文档列表
+    """
+    memory_factor = 8
+    # 文档列表中每个按钮连同其布局项大约占用的内存
+    widget_cost = 4 * 1024
+
+    def __init__(self, datafile: str, data: Data, stats: ContentStats):
+        self.datafile = datafile
+        self.data = data
+        self.stats = stats
+        self.stamp = file_stamp(datafile)
+        self.documents: typing.Optional[DList] = None
+        self.aggregates: typing.Optional[Aggregates] = None
+        self.loading = False
+
+    @property
+    def key(self):
+        return os.path.normcase(os.path.abspath(self.datafile))
+
+    @property
+    def size(self):
+        # 解析后的对象约为 JSON 文本的数倍, 再加上已经建好的文档列表
+        widgets = len(self.documents.widgets) if self.documents is not None else 0
+        return self.memory_factor * (self.stamp[1] if self.stamp else 0) + self.widget_cost * widgets + 1024
+
+
+class Workspace:
+    """
+    最近打开过的大纲的 LRU 缓存, 总估计内存不超过 budget 字节
+    文件在磁盘上被改动过的大纲不会被复用, 它留在缓存中,
+    直到重新加载的同一大纲放入时作为被淘汰者返回, 由调用方释放
+    """
+
+    def __init__(self, budget: int = 256 * 1024 * 1024, capacity: int = 8):
+        self.budget = budget
+        self.capacity = capacity
+        self.entries: OrderedDict[str, Outline] = OrderedDict()
+
+    def __iter__(self):
+        return reversed(self.entries.values())
+
+    def get(self, datafile: str) -> typing.Optional[Outline]:
+        key = os.path.normcase(os.path.abspath(datafile))
+        if (outline := self.entries.get(key)) is None:
+            return None
+        if outline.stamp != file_stamp(datafile):
+            return None
+        self.entries.move_to_end(key)
+        return outline
+
+    def put(self, outline: Outline) -> list[Outline]:
+        """
+        放入(或提到最前)一份大纲, 返回被淘汰的大纲
+        """
+        self.discard(outline)
+        evicted = []
+        if (old := self.entries.pop(outline.key, None)) is not None:
+            evicted.append(old)
+        self.entries[outline.key] = outline
+        used = sum(each.size for each in self.entries.values())
+        while len(self.entries) > 1 and (
+            used > self.budget or len(self.entries) > self.capacity
+        ):
+            _, old = self.entries.popitem(last=False)
+            used -= old.size
+            evicted.append(old)
+        return evicted
+
+    def discard(self, outline: Outline):
+        for key, each in list(self.entries.items()):
+            if each is outline:
+                del self.entries[key]
+
+    def holds(self, outline: Outline):
+        return any(each is outline for each in self.entries.values())
+
+
 class Main(QWidget):
     def __init__(self, proj_path: str):
         super().__init__(*empty_seq)
         self.setWindowTitle("纲目")
 
         self.proj = Project(datafile=proj_path)
+        self.stats = ContentStats(proj_path)
+        self.workspace = Workspace()
+        self.outline: typing.Optional[Outline] = None
+        self.loader: typing.Optional[LoadThread] = None
+        self.loaders: set[LoadThread] = set()
+        self.reconcilers: set[ReconcileThread] = set()
+        self.query_pool: typing.Optional[QueryPool] = None
+        self.query_threads: set[ParallelQueryThread] = set()
+        self.export_threads: set[ExportThread] = set()
         self.context = {}
         layout = self.layout = QVBoxLayout()
         self.data = Data(docs={}, attrs={}, editor="notepad")
@@ -646,15 +2202,77 @@ class Main(QWidget):
         connect(act.triggered, self.save_proj)
         act = outline.addAction("另存为")
         connect(act.triggered, self.save_proj_as)
+        act = outline.addAction("重新关联文档")
+        connect(act.triggered, partial(self.reconcile, True))
+        outline.addSeparator()
+        act = outline.addAction("导出查询结果")
+        connect(act.triggered, lambda: self.export(self.listed().elements()))
+        act = outline.addAction("导出大纲")
+        connect(act.triggered, lambda: self.export(list(self.data.docs.values())))
 
         doc_attr: QMenu = menu.addAction("文档属性")
         connect(doc_attr.triggered, self.doc_attr)
 
+        self.undo_stack = QUndoStack(self)
+        edit: QMenu = menu.addMenu("编辑")
+        act = self.undo_stack.createUndoAction(self, "撤销")
+        act.setShortcut(QKeySequence.Undo)
+        edit.addAction(act)
+        act = self.undo_stack.createRedoAction(self, "重做")
+        act.setShortcut(QKeySequence.Redo)
+        edit.addAction(act)
+        edit.addSeparator()
+        connect(edit.addAction("批量修改属性").triggered, self.bulk_edit)
+
+        aggregate: QMenu = menu.addAction("统计")
+        connect(aggregate.triggered, self.show_aggregates)
+
+        preview: QMenu = menu.addAction("预览")
+        connect(preview.triggered, self.show_preview)
+
+        self.workspace_menu: QMenu = menu.addMenu("工作区")
+        connect(self.workspace_menu.aboutToShow, self.sync_workspace_menu)
+
         settings: QMenu = menu.addMenu("设置")
         connect(settings.addAction("编辑器").triggered, self.editor_setting)
         connect(settings.addAction("大纲路径").triggered, self.change_proj)
+        self.parallel_action = settings.addAction("并行查询")
+        self.parallel_action.setCheckable(True)
+        connect(self.parallel_action.toggled, self.toggle_parallel)
 
         self.layout.setSpacing(5)
+        self.search_input = QLineEdit(self)
+        self.search_input.setPlaceholderText("搜索文档名")
+        self.search_input.setMaximumWidth(340)
+        connect(self.search_input.textChanged, self.search)
+        add_widget(self.layout, self.search_input)
+        # 名字搜索的结果盖在查询结果之上, 不进布局: 查询结果的按钮不必隐藏、重排或重建,
+        # 清空搜索框时收起即可
+        self.search_results = self.new_documents()
+        self.search_results.setParent(self)
+        self.search_results.setAutoFillBackground(True)
+        self.search_results.hide()
+        self.edited_in_search: set[str] = set()
+
+        self.query_picker = QComboBox()
+        self.query_picker.setMinimumWidth(120)
+        connect(self.query_picker.activated, self.pick_query)
+        query_row_layout = QHBoxLayout()
+        query_row_layout.setContentsMargins(0, 0, 0, 0)
+        add_widget(query_row_layout, self.query_picker)
+        for text, f in (
+            ("保存查询", self.save_query),
+            ("删除查询", self.delete_query),
+            ("查询统计", self.query_stats),
+        ):
+            btn = QPushButton(text)
+            proper_sized(btn)
+            connect(btn.clicked, f)
+            add_widget(query_row_layout, btn)
+        query_row = QWidget()
+        query_row.setLayout(query_row_layout)
+        add_widget(self.layout, query_row)
+
         self.filter = DInput("过滤")
         self.sorter = DInput("排序", self)
         self.query_button = QPushButton("查询")
@@ -663,6 +2281,23 @@ class Main(QWidget):
         add_widget(self.layout, self.filter)
         add_widget(self.layout, self.sorter)
         add_widget(self.layout, self.query_button)
+        self.cancel_query_button = QPushButton("取消查询")
+        connect(self.cancel_query_button.clicked, self.cancel_query)
+        self.cancel_query_button.hide()
+        add_widget(self.layout, self.cancel_query_button)
+
+        self.load_progress = QProgressBar()
+        self.cancel_load_button = QPushButton("取消")
+        proper_sized(self.cancel_load_button)
+        connect(self.cancel_load_button.clicked, self.cancel_load)
+        load_row_layout = QHBoxLayout()
+        load_row_layout.setContentsMargins(0, 0, 0, 0)
+        add_widget(load_row_layout, self.load_progress)
+        add_widget(load_row_layout, self.cancel_load_button)
+        self.load_row = QWidget()
+        self.load_row.setLayout(load_row_layout)
+        self.load_row.hide()
+        add_widget(self.layout, self.load_row)
         add_widget(self.layout, separator())
 
         self.attrs = DocAttrs(self)
@@ -673,50 +2308,171 @@ class Main(QWidget):
         self.attrs.setMinimumHeight(100)
         connect(self.attrs.right_click, self.attr_box_right_click)
 
-        self.documents = DList()
-        self.documents.layout.setAlignment(Qt.AlignCenter | Qt.AlignTop)
+        self.documents = self.new_documents()
 
         # self.attrs.item_on_left_click = self.attrs_item_left_click
         self.attrs.item_on_right_click = self.attrs_item_right_click
 
-        self.documents.item_on_left_click = self.document_item_left_click
-        self.documents.item_on_right_click = self.document_item_right_click
+        self.aggregate_pane = AggregatePane(self)
+        self.preview = DocPreview()
 
         add_widget(self.layout, self.documents)
         self.setLayout(self.layout)
         self.layout.setAlignment(Qt.AlignTop | Qt.AlignCenter)
 
+        # 加载完成前的占位大纲, 不进入工作区, 也不能保存
+        self.outline = Outline(proj_path, self.data, self.stats)
+        self.outline.loading = True
+        self.aggregates = Aggregates(self.data, self.stats)
+        self.attr_lookup = {}
         self.load_proj(self.proj.datafile)
 
+    def new_documents(self):
+        documents = DList()
+        documents.layout.setAlignment(Qt.AlignCenter | Qt.AlignTop)
+        documents.item_on_left_click = self.document_item_left_click
+        documents.item_on_right_click = self.document_item_right_click
+        return documents
+
     def reload(self, data: Data):
-        self.data = data
-        self.attrs.clear()
-        self.documents.clear()
+        self.switch(Outline(self.proj.datafile, data, self.stats))
+
+    def switch(self, outline: Outline):
+        """
+        切换到工作区中的一份大纲, 已经建好的文档列表和统计直接复用
+        """
+        previous, self.outline = self.outline, outline
+        self.proj.datafile = outline.datafile
+        if self.query_pool is not None and previous is not outline:
+            # 进程池中是上一份大纲的副本
+            self.query_pool.close()
+            self.query_pool = None
+        self.data = data = outline.data
+        self.stats = outline.stats
         self.context = {}
         self.attr_lookup = {}
-        for doc in data.docs.values():
-            self.documents.add(Datum(doc))
 
+        if outline.documents is None:
+            outline.documents = self.new_documents()
+            for doc in data.docs.values():
+                outline.documents.add(Datum(doc))
+        self.search_input.clear()
+        if outline.documents is not self.documents:
+            self.layout.replaceWidget(self.documents, outline.documents)
+            self.documents.hide()
+            if previous is None or not self.workspace.holds(previous):
+                self.documents.deleteLater()
+            outline.documents.show()
+            outline.documents.resize_items()
+            self.documents = outline.documents
+
+        self.undo_stack.clear()
+        for saved in data.queries.values():
+            try:
+                saved.plan()
+            except SyntaxError:
+                pass
+        self.sync_query_picker()
+        DList.clear(self.attrs)
         for attr in data.attrs.values():
             DList.add(self.attrs, Datum(attr))
 
+        if outline.aggregates is None:
+            outline.aggregates = Aggregates(data, self.stats)
+        self.aggregates = outline.aggregates
+        self.aggregate_pane.sync()
+
+        # 正在加载的大纲加载成功后才放入工作区
+        if not outline.loading:
+            self.keep(outline)
+
+    def keep(self, outline: Outline):
+        """
+        放入工作区, 释放被淘汰的大纲已经建好的文档列表
+        """
+        for old in self.workspace.put(outline):
+            if old.documents is not None:
+                old.documents.clear()
+                old.documents.deleteLater()
+                old.documents = None
+
+    def sync_workspace_menu(self):
+        self.workspace_menu.clear()
+        for outline in self.workspace:
+            act = self.workspace_menu.addAction(pathlib.Path(outline.datafile).name)
+            act.setToolTip(outline.datafile)
+            act.setCheckable(True)
+            act.setChecked(outline is self.outline)
+            connect(act.triggered, partial(self.load_proj, outline.datafile))
+
+    def refresh_stats(self):
+        self.stats_changed(self.outline, self.stats.refresh(doc.path for doc in self.data.docs.values()))
+
+    def stats_changed(self, outline: Outline, changed: set[str]):
+        """
+        内容统计有变化的文档: 更新分组统计, 并把新的统计发给查询进程
+        """
+        if not changed or outline is not self.outline:
+            return
+        for doc in self.data.docs.values():
+            if doc.path in changed:
+                self.aggregates.update(doc)
+        self.aggregate_pane.sync()
+        if self.query_pool is not None:
+            keys = {self.stats.key(path) for path in changed}
+            self.query_pool.set_stats({key: self.stats.entries.get(key) for key in keys})
+
+    def doc_changed(self, doc: Document):
+        self.docs_changed([doc])
+
+    def docs_changed(self, docs: list[Document]):
+        docs = [doc for doc in docs if self.data.docs.get(doc.id) is doc]
+        if not self.search_results.isHidden():
+            self.edited_in_search.update(doc.id for doc in docs)
+        for doc in docs:
+            self.aggregates.update(doc)
+        self.aggregate_pane.sync()
+        self.documents.update()
+        if self.query_pool is not None:
+            self.query_pool.put(docs)
+
+    def doc_removed(self, doc_id: str):
+        self.aggregates.discard(doc_id)
+        self.aggregate_pane.sync()
+        if self.query_pool is not None:
+            self.query_pool.drop([doc_id])
+
+    def attrs_changed(self):
+        self.aggregates.rebuild()
+        self.aggregate_pane.sync()
+        if self.query_pool is not None:
+            self.query_pool.set_attrs(self.data.attrs)
+
     def query(self):
 
         def wrap(f):
             def apply(obj):
-                obj = QueryProxy(obj, self.data.attrs, self.attr_lookup)
+                obj = QueryProxy(obj, self.data.attrs, self.attr_lookup, self.stats)
                 return f(obj)
             return apply
     
-        if filter_code := self.filter.register.text():
-            F = eval(f"lambda _: {filter_code}")
+        self.search_input.clear()
+        start = time.perf_counter()
+        filter_code = self.filter.register.text()
+        sorter_code = self.sorter.register.text()
+        saved = self.current_saved_query()
+        if saved is not None:
+            F, S = saved.plan()
         else:
-            F = None
+            F = compile_query(filter_code)
+            S = compile_query(sorter_code)
 
-        if sorter_code := self.sorter.register.text():
-            S = eval(f"lambda _: {sorter_code}")
-        else:
-            S = None
+        if ContentStats.mentioned(filter_code, sorter_code):
+            self.refresh_stats()
+
+        if self.parallel_action.isChecked() and (F or S):
+            self.parallel_query(filter_code, sorter_code, saved, start)
+            return
 
         seq = self.data.docs.values()
         try:
@@ -741,6 +2497,228 @@ class Main(QWidget):
         self.documents.clear()
         for each in seq:
             self.documents.add(Datum(each))
+        if saved is not None:
+            saved.record(time.perf_counter() - start, len(seq))
+            self.sync_query_picker()
+
+    def current_saved_query(self) -> typing.Optional[SavedQuery]:
+        """
+        选中的已存查询, 过滤、排序框中的内容被改过时不算
+        """
+        saved = self.data.queries.get(self.query_picker.currentText())
+        if saved is None:
+            return None
+        if (saved.filter, saved.sorter) != (
+            self.filter.register.text(),
+            self.sorter.register.text(),
+        ):
+            return None
+        return saved
+
+    def sync_query_picker(self):
+        current = self.query_picker.currentText()
+        self.query_picker.clear()
+        self.query_picker.addItem("")
+        for i, saved in enumerate(self.data.queries.values(), 1):
+            self.query_picker.addItem(saved.item_name)
+            self.query_picker.setItemData(i, saved.describe(), Qt.ToolTipRole)
+        if current in self.data.queries:
+            self.query_picker.setCurrentText(current)
+
+    def pick_query(self, index: int):
+        if (saved := self.data.queries.get(self.query_picker.itemText(index))) is None:
+            return
+        self.filter.register.setText(saved.filter)
+        self.sorter.register.setText(saved.sorter)
+        if self.query_button.isEnabled():
+            self.query()
+
+    def save_query(self):
+        name, ok = QInputDialog.getText(
+            self, "保存查询", "查询名", text=self.query_picker.currentText()
+        )
+        name = name.strip()
+        if not ok or not name:
+            return
+        saved = SavedQuery(
+            name=name,
+            filter=self.filter.register.text(),
+            sorter=self.sorter.register.text(),
+        )
+        try:
+            saved.plan()
+        except SyntaxError as e:
+            msg_box = QMessageBox()
+            msg_box.setText(f"查询有语法错误: {e}")
+            msg_box.exec_()
+            return
+        self.data.queries[name] = saved
+        self.sync_query_picker()
+        self.query_picker.setCurrentText(name)
+
+    def delete_query(self):
+        if self.data.queries.pop(self.query_picker.currentText(), None) is not None:
+            self.query_picker.setCurrentIndex(0)
+            self.sync_query_picker()
+
+    def query_stats(self):
+        """
+        按上次耗时从高到低列出已存查询
+        """
+        queries = sorted(self.data.queries.values(), key=lambda q: -q.last_latency)
+        msg_box = QMessageBox()
+        msg_box.setWindowTitle("查询统计")
+        msg_box.setText(
+            "\n".join(f"{q.name}: {q.describe()}" for q in queries) or "没有已存查询"
+        )
+        msg_box.exec_()
+
+    def parallel_query(
+        self,
+        filter_code: str,
+        sorter_code: str,
+        saved: typing.Optional[SavedQuery] = None,
+        start: float = 0.0,
+    ):
+        """
+        在查询进程池中执行, 进程池在第一次用到时于查询线程中建立并载入当前大纲
+        """
+        if self.query_pool is None:
+            self.query_pool = QueryPool()
+        pool = self.query_pool
+        pool.cancel.clear()
+        thread = ParallelQueryThread(pool, filter_code, sorter_code, self.data, self.stats)
+        self.query_threads.add(thread)
+        connect(thread.done, partial(self.parallel_done, self.outline, pool, saved, start))
+        connect(thread.finished, partial(self.query_threads.discard, thread))
+        self.query_button.setEnabled(False)
+        self.cancel_query_button.show()
+        thread.start()
+
+    def parallel_done(
+        self,
+        outline: Outline,
+        pool: QueryPool,
+        saved: typing.Optional[SavedQuery],
+        start: float,
+        result: tuple,
+    ):
+        self.query_button.setEnabled(self.loader is None)
+        self.cancel_query_button.hide()
+        if pool is self.query_pool and not pool.ready:
+            # 载入途中被取消, 进程池不完整
+            pool.close()
+            self.query_pool = None
+        if outline is not self.outline or result[0] == "cancelled":
+            return
+        if result[0] == "error":
+            _, stage, msg = result
+            msg_box = QMessageBox()
+            msg_box.setText(f"{stage}函数有错误: {msg}")
+            msg_box.exec_()
+            return
+        docs = self.data.docs
+        self.documents.clear()
+        for doc_id in result[1]:
+            if (doc := docs.get(doc_id)) is not None:
+                self.documents.add(Datum(doc))
+        if saved is not None:
+            saved.record(time.perf_counter() - start, len(result[1]))
+            self.sync_query_picker()
+
+    def cancel_query(self):
+        if self.query_pool is not None:
+            self.query_pool.cancel.set()
+
+    def toggle_parallel(self, checked: bool):
+        if not checked and self.query_pool is not None:
+            self.query_pool.close()
+            self.query_pool = None
+
+    def bulk_edit(self):
+        """
+        对当前列表中的所有文档设置、清除或增加同一属性
+        """
+        docs = self.listed().elements()
+        if not docs or not self.data.attrs:
+            return
+        datum = Datum(None)
+        BulkEditAttr(datum, self.data.attrs, len(docs)).exec_()
+        if datum.v is None:
+            return
+        attr, op, v = datum.v
+        changes = []
+        skipped = []
+        for doc in docs:
+            old = doc.attrs.get(attr.id, _missing)
+            if op == "清除":
+                new = _missing
+            elif op == "增加":
+                try:
+                    new = v if old is _missing else old + v
+                except TypeError:
+                    skipped.append(doc)
+                    continue
+            else:
+                new = v
+            if new is _missing or old is _missing:
+                if new is not old:
+                    changes.append((doc, old, new))
+            elif new != old:
+                changes.append((doc, old, new))
+        if changes:
+            self.undo_stack.push(
+                AttrEditCommand(self, attr.id, changes, f"批量{op}「{attr.name}」")
+            )
+        if skipped:
+            names = "\n".join(doc.name for doc in skipped[:20])
+            if len(skipped) > 20:
+                names += f"\n... 等共 {len(skipped)} 个"
+            msg_box = QMessageBox()
+            msg_box.setText(f"以下文档的「{attr.name}」无法增加 {v!r}, 已跳过:\n{names}")
+            msg_box.exec_()
+
+    def listed(self) -> DList:
+        """
+        当前显示的文档列表: 搜索结果或查询结果
+        """
+        return self.documents if self.search_results.isHidden() else self.search_results
+
+    def search(self, text: str):
+        """
+        边输入边按名字搜索, 清空时收起搜索结果, 查询结果一直保留
+        """
+        results = self.search_results
+        if not text.strip():
+            if results.isHidden():
+                return
+            results.hide()
+            results.clear()
+            # 搜索期间改过的文档, 查询结果中的按钮还是旧的
+            if self.edited_in_search:
+                for datum in self.documents.data:
+                    if datum.v.id in self.edited_in_search:
+                        datum.notify()
+                self.edited_in_search.clear()
+            return
+        results.setUpdatesEnabled(False)
+        results.clear()
+        for each in self.data.search_names(text):
+            results.add(Datum(each))
+        results.setUpdatesEnabled(True)
+        if results.isHidden():
+            self.place_search_results()
+            results.show()
+            results.raise_()
+
+    def place_search_results(self):
+        self.search_results.setGeometry(self.documents.geometry())
+        self.search_results.resize_items()
+
+    def resizeEvent(self, e: QResizeEvent):
+        super().resizeEvent(e)
+        if not self.search_results.isHidden():
+            self.place_search_results()
 
     def editor_setting(self):
         editor_name, ok = QInputDialog.getText(self, "编辑器设置", "属性名")
@@ -754,6 +2732,35 @@ class Main(QWidget):
         """
         self.attrs.show()
 
+    def show_preview(self):
+        """
+        预览窗口打开时, 左键点击文档只预览而不启动编辑器
+        """
+        self.preview.show()
+
+    def show_aggregates(self):
+        self.aggregate_pane.show()
+
+    def add_aggregate(self):
+        datum = Datum(None)
+        DInputAgg(datum, self.data.attrs).exec_()
+        if datum.v is None:
+            return
+        try:
+            self.aggregates.add(datum.v)
+        except ValueError as e:
+            msg_box = QMessageBox()
+            msg_box.setText(str(e))
+            msg_box.exec_()
+            return
+        if ContentStats.mentioned(datum.v.attr, datum.v.by):
+            self.refresh_stats()
+        self.aggregate_pane.sync()
+
+    def remove_aggregate(self, item: Aggregate):
+        self.aggregates.remove(item)
+        self.aggregate_pane.sync()
+
     def attr_box_right_click(self):
         popMenu = QMenu(self)
         popMenu.addAction("添加属性", self.add_attr)
@@ -761,12 +2768,14 @@ class Main(QWidget):
 
     def edit_attr_for_attr(self, obj: Datum[Attr]):
         DModifyAttr(obj, self.data.attrs).exec_()
+        self.attrs_changed()
 
     def add_attr(self):
         datum = Datum(None)
         DInputAttr(datum, self.data.attrs).exec_()
         if datum.v is not None:
             self.attrs.add(typing.cast(Datum[Attr], datum))
+            self.attrs_changed()
 
     def add_nove_doc(self):
         options = QFileDialog.Options()
@@ -782,7 +2791,11 @@ class Main(QWidget):
         )
         if not doc_paths:
             return
+        duplicated = []
         for doc_path in doc_paths:
+            if (found := self.data.doc_by_path(doc_path)) is not None:
+                duplicated.append(f"{doc_path} ({found.name})")
+                continue
             doc = Document(
                 id=uuid_str(),
                 name=pathlib.Path(doc_path).with_suffix("").name,
@@ -790,12 +2803,120 @@ class Main(QWidget):
                 path=doc_path,
             )
             self.documents.add(Datum(doc))
-            self.data.docs[doc.id] = doc
+            self.data.add_doc(doc)
+            self.doc_changed(doc)
+        if duplicated:
+            msg_box = QMessageBox()
+            msg_box.setText("以下文档已在大纲中:\n" + "\n".join(duplicated))
+            msg_box.exec_()
+
+    def reconcile(self, manual: bool = False):
+        """
+        在后台为文件被改名或移动的文档寻找新位置
+        """
+        docs = list(self.data.docs.values())
+        # 加载后自动进行时只找大纲所在目录, 以免遍历整个家目录
+        roots = reconcile_roots(self.proj.datafile, docs, manual)
+        thread = ReconcileThread(docs, self.stats, roots)
+        self.reconcilers.add(thread)
+        connect(thread.relinked, partial(self.relink, self.outline, manual))
+        connect(thread.refreshed, partial(self.stats_changed, self.outline))
+        connect(thread.finished, partial(self.reconcilers.discard, thread))
+        thread.start()
+
+    def relink(self, outline: Outline, manual: bool, moved: dict[str, str]):
+        data = outline.data
+        relinked = []
+        for doc_id, path in moved.items():
+            if (doc := data.docs.get(doc_id)) is not None:
+                relinked.append(f"{doc.name}: {doc.path} -> {path}")
+                data.move_doc(doc, path)
+                if outline is self.outline:
+                    self.doc_changed(doc)
+        if relinked or manual:
+            msg_box = QMessageBox()
+            msg_box.setText(
+                f"已重新关联 {len(relinked)} 个文档" + "".join(f"\n{each}" for each in relinked[:20])
+            )
+            msg_box.exec_()
 
     def load_proj(self, datafile: str):
-        self.proj.datafile = datafile
-        data = self.proj.load()
-        self.reload(data)
+        self.cancel_load()
+        if (outline := self.workspace.get(datafile)) is not None:
+            self.switch(outline)
+            return
+
+        loader = self.loader = LoadThread(datafile)
+        self.loaders.add(loader)
+        connect(loader.header, partial(self.load_header, loader))
+        connect(loader.chunk, partial(self.load_chunk, loader))
+        connect(loader.progress, partial(self.load_progressed, loader))
+        connect(loader.failed, partial(self.load_failed, loader))
+        connect(loader.finished, partial(self.load_finished, loader))
+        self.load_progress.setValue(0)
+        self.load_row.show()
+        self.query_button.setEnabled(False)
+        loader.start()
+
+    def cancel_load(self):
+        """
+        中止正在进行的加载, 已加载的部分不会进入工作区, 也不能保存
+        """
+        if (loader := self.loader) is None:
+            return
+        self.loader = None
+        loader.requestInterruption()
+        if loader.outline is not None:
+            self.workspace.discard(loader.outline)
+        self.load_row.hide()
+        self.query_button.setEnabled(True)
+
+    def load_header(self, loader: LoadThread, data: Data, stats: ContentStats):
+        if self.loader is not loader:
+            return
+        outline = loader.outline = Outline(loader.datafile, data, stats)
+        outline.stamp = loader.stamp
+        # 名字索引随文档分批加入而建立, 不必在第一次搜索时一次建好
+        data.name_index()
+        outline.loading = True
+        self.switch(outline)
+
+    def load_chunk(self, loader: LoadThread, docs: list[Document]):
+        if self.loader is not loader:
+            return
+        outline = loader.outline
+        for doc in docs:
+            outline.data.add_doc(doc)
+            outline.documents.add(Datum(doc))
+            outline.aggregates.update(doc)
+
+    def load_progressed(self, loader: LoadThread, value: int):
+        if self.loader is loader:
+            self.load_progress.setValue(value)
+
+    def load_failed(self, loader: LoadThread, msg: str):
+        if self.loader is not loader:
+            return
+        # 只加载了一部分的大纲保持 loading, 不能保存, 也不进入工作区
+        loader.error = msg
+        if loader.outline is not None:
+            self.workspace.discard(loader.outline)
+        msg_box = QMessageBox()
+        msg_box.setText(f"大纲加载失败: {msg}")
+        msg_box.exec_()
+
+    def load_finished(self, loader: LoadThread):
+        self.loaders.discard(loader)
+        if self.loader is not loader:
+            return
+        self.loader = None
+        self.load_row.hide()
+        self.query_button.setEnabled(True)
+        self.aggregate_pane.sync()
+        if loader.outline is not None and loader.error is None:
+            loader.outline.loading = False
+            self.keep(loader.outline)
+            self.reconcile()
 
     def new_proj(self):
         init_path = str(pathlib.Path(self.proj.datafile).absolute().parent)
@@ -804,6 +2925,7 @@ class Main(QWidget):
         )
 
         self.proj.datafile = datafile
+        self.stats = ContentStats(datafile)
         self.reload(Data.empty())
         self.save_proj()
 
@@ -812,7 +2934,15 @@ class Main(QWidget):
         datafile, _ = QFileDialog.getSaveFileName(
             self, "选择项目", init_path, "All Files (*);;JSON Files (*.json)"
         )
+        if not datafile:
+            return
         self.proj.datafile = datafile
+        self.stats.datafile = datafile
+        self.outline.datafile = datafile
+        self.outline.stamp = file_stamp(datafile)
+        # 尚未加载完的大纲不进入工作区
+        if not self.outline.loading:
+            self.keep(self.outline)
 
     def open_proj(self):
         options = QFileDialog.Options()
@@ -829,8 +2959,19 @@ class Main(QWidget):
             return
         self.load_proj(datafile)
 
+    def loading_refused(self):
+        if not self.outline.loading:
+            return False
+        msg_box = QMessageBox()
+        msg_box.setText("大纲尚未加载完毕, 不能保存")
+        msg_box.exec_()
+        return True
+
     def save_proj(self):
+        if self.loading_refused():
+            return
         self.proj.save(self.data)
+        self.outline.stamp = file_stamp(self.proj.datafile)
 
     def save_proj_as(self):
         options = QFileDialog.Options()
@@ -845,8 +2986,42 @@ class Main(QWidget):
         )
         if not proj_path:
             return
+        if self.loading_refused():
+            return
         Project(proj_path).save(self.data)
 
+    def export(self, docs: list[Document]):
+        options = QFileDialog.Options()
+        init_path = str(pathlib.Path(self.proj.datafile).absolute().parent)
+        # noinspection PyTypeChecker
+        path, _ = QFileDialog.getSaveFileName(
+            self,
+            "导出",
+            init_path,
+            "CSV Files (*.csv);;JSON Lines (*.jsonl);;Markdown (*.md)",
+            options=options,
+        )
+        if not path:
+            return
+        fmt = pathlib.Path(path).suffix.lstrip(".").lower()
+        if fmt not in exporters:
+            msg_box = QMessageBox()
+            msg_box.setText(f"不支持的导出格式: {fmt}")
+            msg_box.exec_()
+            return
+
+        def failed(msg):
+            msg_box = QMessageBox()
+            msg_box.setText(f"导出失败: {msg}")
+            msg_box.exec_()
+
+        data = self.data.copy(update=dict(attrs=dict(self.data.attrs)))
+        thread = ExportThread(docs, data, fmt, path)
+        self.export_threads.add(thread)
+        connect(thread.failed, failed)
+        connect(thread.finished, partial(self.export_threads.discard, thread))
+        thread.start()
+
     def ref_obj(self, datum: Datum):
         var = datum.name.isidentifier() and datum.name or ""
         while var in self.context:
@@ -856,7 +3031,8 @@ class Main(QWidget):
         pyperclip.copy(var)
 
     def edit_attr_for_doc(self, obj: Datum[Document]):
-        ChangeDocAttr(obj, self.data.attrs).exec_()
+        ChangeDocAttr(obj, self.data).exec_()
+        self.doc_changed(obj.v)
 
     def attrs_item_right_click(self, btn: DListItem):
         popMenu = QMenu(self)
@@ -869,18 +3045,36 @@ class Main(QWidget):
     def document_item_right_click(self, btn: DListItem):
         popMenu = QMenu(self)
         popMenu.addAction("属性编辑", partial(self.edit_attr_for_doc, btn.datum))
+        popMenu.addAction("打开", partial(self.open_doc, btn))
+        popMenu.addAction("预览", partial(self.preview_doc, btn))
         popMenu.addAction("引用", partial(self.ref_obj, btn.datum))
-        popMenu.addAction("在列表中删除", partial(self.documents.remove, btn))
+        popMenu.addAction("在列表中删除", partial(self.listed().remove, btn))
         popMenu.addSeparator()
         popMenu.addAction("数据删除", partial(self.document_delete, btn))
         popMenu.exec_(self.cursor().pos())
 
     def document_delete(self, btn):
-        self.documents.remove(btn)
-        del self.data.docs[btn.datum.v.id]
+        listed = self.listed()
+        listed.remove(btn)
+        if listed is not self.documents:
+            doc = btn.datum.v
+            if (datum := next((d for d in self.documents.data if d.v is doc), None)) is not None:
+                self.documents.remove(datum)
+        self.data.remove_doc(btn.datum.v.id)
+        self.doc_removed(btn.datum.v.id)
         
 
     def document_item_left_click(self, btn: DListItem):
+        if self.preview.isVisible():
+            self.preview_doc(btn)
+        else:
+            self.open_doc(btn)
+
+    def preview_doc(self, btn: DListItem):
+        self.preview.preview(typing.cast(Document, btn.datum.v))
+        self.preview.show()
+
+    def open_doc(self, btn: DListItem):
         doc: Document = typing.cast(Document, btn.datum.v)
         editor = which(self.data.editor)
         if editor is None:
@@ -906,6 +3100,28 @@ def exception_hook(exctype, value, traceback):
 
 sys.excepthook = exception_hook
 
+headless_commands = {}
+
+
+def headless(f):
+    headless_commands[f.__name__] = f
+    return f
+
+
+@headless
+def aggregate(proj_path: str, attr: str, *, func: str = "求和", by: str = ""):
+    """
+    按属性统计大纲中的文档, 逐行输出「分组<TAB>值」
+    func: 求和, 计数, 最小值, 最大值, 平均值
+    """
+    data = Project(proj_path).load()
+    stats = ContentStats(proj_path)
+    if ContentStats.mentioned(attr, by):
+        stats.refresh(doc.path for doc in data.docs.values())
+    item = Aggregate(AggSpec(func=func, attr=attr, by=by), data, stats)
+    for k, v in item.results():
+        print(f"{'' if k is None else k}\t{v}")
+
 def nove(proj_path: str):
     os.environ["QT_AUTO_SCREEN_SCALE_FACTOR"] = "1"
     app = QApplication([])
@@ -925,5 +3141,340 @@ def nove(proj_path: str):
     sys.exit(app.exec_())
 
 
+@headless
+def export(proj_path: str, *, fmt: str = "csv", filter: str = "", sort: str = "", out: str = ""):
+    """
+    导出大纲中的文档, fmt: csv, jsonl, md
+    filter, sort 与界面中「过滤」「排序」的写法相同; 不指定 out 时写到标准输出
+    """
+    if fmt not in exporters:
+        sys.exit(f"不支持的导出格式: {fmt}")
+    data = Project(proj_path).load()
+    stats = ContentStats(proj_path)
+    try:
+        F = compile_query(filter)
+        S = compile_query(sort)
+    except SyntaxError as e:
+        sys.exit(f"查询有语法错误: {e}")
+    if ContentStats.mentioned(filter, sort):
+        stats.refresh(doc.path for doc in data.docs.values())
+    attr_lookup = {}
+
+    def wrap(f):
+        def apply(obj):
+            obj = QueryProxy(obj, data.attrs, attr_lookup, stats)
+            return f(obj)
+        return apply
+
+    # 先求出全部结果再写, 表达式出错时不会留下写了一半的输出; 只是文档的引用, 行仍逐行生成
+    docs = list(data.docs.values())
+    if F:
+        try:
+            docs = [doc for doc in docs if wrap(F)(doc)]
+        except Exception as e:
+            sys.exit(f"过滤函数有错误: {e}")
+    if S:
+        try:
+            docs.sort(key=wrap(S))
+        except Exception as e:
+            sys.exit(f"排序函数有错误: {e}")
+    if out:
+        try:
+            with open(out, "w", encoding="utf-8", newline="") as f:
+                export_docs(docs, data, fmt, f)
+        except OSError as e:
+            if os.path.exists(out):
+                os.remove(out)
+            sys.exit(f"导出失败: {e}")
+    else:
+        try:
+            export_docs(docs, data, fmt, sys.stdout)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+class RPCError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class OutlineServer:
+    """
+    常驻一份大纲, 以 JSON-RPC 2.0 (每行一个 JSON) 提供查询与属性读写
+    查询写法与界面中的「过滤」「排序」一致, 保存走同一个 Project
+    """
+
+    def __init__(self, datafile: str):
+        self.proj = Project(datafile)
+        # 载入时文件的状态, 保存前比对, 以免覆盖界面等其它程序在此期间的保存
+        self.stamp = file_stamp(datafile)
+        self.data = self.proj.load()
+        self.stats = ContentStats(datafile)
+        self.attr_lookup = {}
+        self.dirty = False
+        # 监听端口时, 连接后第一行须是写在 <大纲文件>.token 中的令牌
+        self.token: typing.Optional[str] = None
+        self.methods = {
+            "query": self.query,
+            "get": self.get,
+            "set": self.set,
+            "attrs": self.attrs,
+            "doc_by_path": self.doc_by_path,
+            "search": self.search,
+            "save": self.save,
+        }
+
+    def proxy(self, doc: Document):
+        return QueryProxy(doc, self.data.attrs, self.attr_lookup, self.stats)
+
+    def doc(self, doc_id: str) -> Document:
+        try:
+            return self.data.docs[doc_id]
+        except KeyError:
+            raise RPCError(-32602, f"找不到文档: {doc_id}") from None
+
+    def query(self, filter: str = "", sort: str = ""):
+        try:
+            F = compile_query(filter)
+            S = compile_query(sort)
+        except SyntaxError as e:
+            raise RPCError(-32602, f"表达式有语法错误: {e}") from None
+        if ContentStats.mentioned(filter, sort):
+            self.stats.refresh(doc.path for doc in self.data.docs.values())
+        seq = self.data.docs.values()
+        try:
+            seq = [doc for doc in seq if F(self.proxy(doc))] if F else list(seq)
+        except Exception as e:
+            raise RPCError(-32000, f"过滤函数有错误: {e}") from None
+        if S:
+            try:
+                seq.sort(key=lambda doc: S(self.proxy(doc)))
+            except Exception as e:
+                raise RPCError(-32000, f"排序函数有错误: {e}") from None
+        return [dict(id=doc.id, name=doc.name, path=doc.path) for doc in seq]
+
+    def get(self, doc: str, attr: str):
+        obj = self.doc(doc)
+        if attr in ContentStats.names:
+            self.stats.refresh([obj.path])
+        elif attr not in ("名字", "文件路径") and not any(a.name == attr for a in self.data.attrs.values()):
+            raise RPCError(-32602, f"找不到属性: {attr}")
+        return getattr(self.proxy(obj), attr)
+
+    def set(self, doc: str, attr: str, value: typing.Optional[Value] = None):
+        obj = self.doc(doc)
+        if attr == "名字":
+            if value is None or not str(value).strip():
+                raise RPCError(-32602, "文档名不能为空")
+            self.data.rename_doc(obj, str(value).strip())
+            self.dirty = True
+            return obj.name
+        found = next((a for a in self.data.attrs.values() if a.name == attr), None)
+        if found is None:
+            raise RPCError(-32602, f"找不到属性: {attr}")
+        if value is None:
+            self.data.unset_value(obj, found.id)
+        else:
+            typ = parse_type(found.typ)
+            # 字符串与界面中的输入一样解析; 其它 JSON 值须与属性类型一致, 不做隐式转换
+            if isinstance(value, str):
+                try:
+                    value = typ(value)
+                except ValueError:
+                    typ = None
+            elif typ is float and type(value) is int:
+                value = float(value)
+            elif type(value) is not typ:
+                typ = None
+            if typ is None:
+                raise RPCError(-32602, f"属性「{found.name}」要求类型{found.typ}: {value!r}")
+            self.data.set_value(obj, found.id, value)
+        self.dirty = True
+        return value
+
+    def attrs(self):
+        return [attr.dict() for attr in self.data.attrs.values()]
+
+    def search(self, query: str, limit: int = 50):
+        return [
+            dict(id=doc.id, name=doc.name, path=doc.path)
+            for doc in self.data.search_names(query, limit)
+        ]
+
+    def doc_by_path(self, path: str):
+        if (doc := self.data.doc_by_path(path)) is None:
+            return None
+        return dict(id=doc.id, name=doc.name, path=doc.path)
+
+    def save(self):
+        if file_stamp(self.proj.datafile) != self.stamp:
+            raise RPCError(-32000, f"大纲文件在服务启动后被修改过, 拒绝覆盖: {self.proj.datafile}")
+        self.proj.save(self.data)
+        self.stamp = file_stamp(self.proj.datafile)
+        self.dirty = False
+        return True
+
+    def handle(self, request) -> typing.Optional[dict]:
+        if isinstance(request, list):
+            return [r for r in map(self.handle, request) if r is not None] or None
+        if not isinstance(request, dict):
+            return dict(jsonrpc="2.0", id=None, error=dict(code=-32600, message="无效请求"))
+        req_id = request.get("id")
+        try:
+            try:
+                method = self.methods[request.get("method")]
+            except (KeyError, TypeError):
+                raise RPCError(-32601, f"未知方法: {request.get('method')}") from None
+            params = request.get("params") or {}
+            try:
+                result = method(*params) if isinstance(params, list) else method(**params)
+            except TypeError as e:
+                raise RPCError(-32602, str(e)) from None
+            except OSError as e:
+                raise RPCError(-32000, f"读写文件失败: {e}") from None
+        except RPCError as e:
+            response = dict(jsonrpc="2.0", id=req_id, error=dict(code=e.code, message=e.message))
+        else:
+            response = dict(jsonrpc="2.0", id=req_id, result=result)
+        return response if "id" in request else None
+
+    def write_token(self) -> str:
+        self.token = secrets.token_hex(16)
+        path = f"{self.proj.datafile}.token"
+        if os.path.exists(path):
+            os.remove(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(self.token + "\n")
+        return path
+
+    async def serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            if self.token is not None:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    line = b""
+                if not hmac.compare_digest(line.strip(), self.token.encode("ascii")):
+                    return
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # 超过长度上限的一行已被丢弃
+                    response = dict(jsonrpc="2.0", id=None, error=dict(code=-32000, message="请求过长"))
+                else:
+                    if not line:
+                        break
+                    try:
+                        request = json.loads(line)
+                    except ValueError:
+                        response = dict(jsonrpc="2.0", id=None, error=dict(code=-32700, message="无法解析的 JSON"))
+                    else:
+                        response = self.handle(request)
+                if response is not None:
+                    writer.write(self.encode(response).encode("utf-8") + b"\n")
+                    await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # 客户端断开, 或服务退出时取消了仍连着的客户端
+            pass
+        finally:
+            writer.close()
+
+    def encode(self, response) -> str:
+        """
+        批量请求逐个序列化, 无法序列化的结果换成错误响应
+        """
+        if isinstance(response, list):
+            return "[" + ", ".join(map(self.encode, response)) + "]"
+        try:
+            return json.dumps(response, ensure_ascii=False)
+        except (TypeError, ValueError) as e:
+            error = dict(code=-32603, message=f"结果无法序列化: {e}")
+            return json.dumps(dict(jsonrpc="2.0", id=response.get("id"), error=error), ensure_ascii=False)
+
+    async def run(self, socket: str = "", port: int = 0):
+        if socket or not port and hasattr(asyncio, "start_unix_server"):
+            socket = socket or f"{self.proj.datafile}.sock"
+            if os.path.exists(socket):
+                os.remove(socket)
+            # 套接字只允许当前用户连接
+            umask = os.umask(0o177)
+            try:
+                server = await asyncio.start_unix_server(self.serve_client, path=socket)
+            finally:
+                os.umask(umask)
+            print(f"nove serving {self.proj.datafile} on {socket}", flush=True)
+            token_file = None
+        else:
+            token_file = self.write_token()
+            server = await asyncio.start_server(self.serve_client, "127.0.0.1", port)
+            host, port = server.sockets[0].getsockname()[:2]
+            print(f"nove serving {self.proj.datafile} on {host}:{port}, token in {token_file}", flush=True)
+        # 收到 SIGTERM 时与 Ctrl-C 一样正常退出, 删除套接字并保存改动
+        stop = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        except (NotImplementedError, AttributeError):
+            pass
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            for path in (socket, token_file):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+
+@headless
+def serve(proj_path: str, *, socket: str = "", port: int = 0):
+    """
+    常驻大纲并以 JSON-RPC 提供服务, 供编辑器插件等使用
+    默认监听 <大纲文件>.sock; 指定 port 时监听 127.0.0.1 上的端口,
+    连接后先发送一行 <大纲文件>.token 中的令牌
+    方法: query(filter, sort), get(doc, attr), set(doc, attr, value), attrs(), doc_by_path(path),
+    search(query, limit), save()
+    """
+    server = OutlineServer(proj_path)
+    try:
+        asyncio.run(server.run(socket, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server.dirty:
+            try:
+                server.save()
+            except RPCError as e:
+                sys.exit(f"改动未保存: {e.message}")
+
+
+@headless
+def compact(proj_path: str, *, dry_run: bool = False):
+    """
+    清理大纲中已删除属性残留在文档里的值
+    dry_run: 只报告, 不写回
+    """
+    data = Project(proj_path).load()
+    dead = data.dead_values()
+    for attr_id, n in sorted(dead.items(), key=lambda kv: -kv[1]):
+        print(f"{attr_id}\t{n}")
+    total = sum(dead.values())
+    if dry_run or not total:
+        print(f"残留值: {total}")
+        return
+    Project(proj_path).save(data)
+    print(f"已清理残留值: {total}")
+
+
+def cmd():
+    argv = sys.argv[1:]
+    if argv and argv[0] in headless_commands:
+        return wisepy2.wise(headless_commands[argv[0]])(argv[1:])
+    return wisepy2.wise(nove)(argv)
+
+
 if __name__ == '__main__':
-    wisepy2.wise(nove)()
+    cmd()